@@ -1,26 +1,33 @@
+import io
 import os
 import re
+import random
 import time
+import functools
 import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import httpx
 import traceback
-import pandas as pd
-import dateutil.parser
-from datetime import datetime
-from zoneinfo import ZoneInfo
+from datetime import datetime, timedelta, timezone
 from flask import Flask, jsonify, request
 from dotenv import load_dotenv
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
 import telebot
+from telebot import apihelper
 from apscheduler.schedulers.background import BackgroundScheduler
-import json
-import html  # <- You need this at the top
+from apscheduler.executors.pool import ThreadPoolExecutor as JobThreadPool
+import orjson
+import queue
 
 # ---------------------------
 # CONFIG
 # ---------------------------
 load_dotenv()
-TZ = ZoneInfo("Asia/Yangon")
+TZ = timezone(timedelta(hours=6, minutes=30))  # Asia/Yangon, no DST
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
@@ -30,39 +37,137 @@ SUPPLIER_GROUP_ID = int(os.getenv("SUPPLIER_GROUP_ID", "0"))
 K2BOOST_GROUP_ID = int(os.getenv("K2BOOST_GROUP_ID", "0"))
 GROUP_ID = int(os.getenv("GROUP_ID", "0"))
 REPORT_GROUP_ID = int(os.getenv("REPORT_GROUP_ID", "0"))
+# Comma-separated chat ids allowed to run admin-only commands like /calculate
+ADMIN_CHAT_IDS = frozenset(int(x) for x in os.getenv("ADMIN_CHAT_IDS", "").split(",") if x.strip())
+ALLOWED_REPORT_CHATS = frozenset({REPORT_GROUP_ID}) | ADMIN_CHAT_IDS
 SMMGEN_API_KEY = os.getenv("SMMGEN_API_KEY")
 SMMGEN_URL = os.getenv("SMMGEN_URL", "https://smmgen.com/api/v2")
+SMMGEN_STATUS_BATCH = 100  # max order ids per action=status request
+SMMGEN_ADD_RETRIES = 3
+SMMGEN_RETRY_STATUSES = {429}  # rate limited before the order was taken
 USD_TO_MMK = float(os.getenv("USD_TO_MMK", "4500"))
+PUBLIC_URL = os.getenv("PUBLIC_URL", "").rstrip("/")  # set to receive Telegram updates by webhook
+_FMT_MMK = "{:,.0f}".format  # prebound MMK formatter, skips format-spec parsing
 
 if not (SUPABASE_URL and SUPABASE_KEY and BOT_TOKEN):
     raise RuntimeError("Please provide SUPABASE_URL, SUPABASE_KEY and TELEGRAM_TOKEN in .env")
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# One pooled HTTP/2 client shared by every PostgREST call (all loops and
+# handlers), sized from the environment
+SUPABASE_HTTP = httpx.Client(
+    http2=True,
+    timeout=25.0,
+    follow_redirects=True,
+    limits=httpx.Limits(
+        max_connections=int(os.getenv("SUPABASE_MAX_CONNECTIONS", "120")),
+        max_keepalive_connections=int(os.getenv("SUPABASE_MAX_KEEPALIVE", "80")),
+    ),
+)
+supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(httpx_client=SUPABASE_HTTP))
 bot = telebot.TeleBot(BOT_TOKEN, parse_mode="Markdown")
-db_lock = threading.Lock()
+# Reuse one keep-alive session for getUpdates long polls
+apihelper.SESSION_TIME_TO_LIVE = 5 * 60
+apihelper.CONNECT_TIMEOUT = 25
 app = Flask(__name__)
-scheduler = BackgroundScheduler(timezone="UTC")
+# The report build gets its own single-worker executor so a slow XLSX
+# export never delays the other jobs; missed runs after downtime are
+# coalesced into one.
+scheduler = BackgroundScheduler(
+    timezone="UTC",
+    executors={"default": JobThreadPool(10), "reports": JobThreadPool(1)},
+    job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 300},
+)
+
+# Keep-alive pool for SMMGEN. urllib3 retries failed connects and, for
+# idempotent methods only, 429/5xx responses (honouring Retry-After), so
+# an order POST is never replayed behind our back.
+smmgen_session = requests.Session()
+smmgen_session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+))
 
 # ---------------------------
 # UTIL / HELPERS
 # ---------------------------
 
-app = Flask(__name__)
+# Command handlers run here so a slow Supabase call in one chat does not
+# hold up updates from others; each chat still runs one command at a time.
+# A chat's commands wait in its own FIFO with at most one drain task in
+# the pool, so a burst from one chat never ties up idle workers.
+HANDLER_POOL = ThreadPoolExecutor(max_workers=16)
+_chat_queues = {}  # chat_id -> deque of (func, message) while draining
+_chat_queues_lock = threading.Lock()
 
-sent_ids = set()
+def _drain_chat(chat_id):
+    while True:
+        with _chat_queues_lock:
+            pending = _chat_queues[chat_id]
+            if not pending:
+                del _chat_queues[chat_id]
+                return
+            func, message = pending.popleft()
+        try:
+            func(message)
+        except Exception:
+            traceback.print_exc()
+
+def pooled(func):
+    @functools.wraps(func)
+    def wrapper(message):
+        chat_id = message.chat.id
+        with _chat_queues_lock:
+            pending = _chat_queues.get(chat_id)
+            if pending is not None:
+                pending.append((func, message))
+                return
+            _chat_queues[chat_id] = deque([(func, message)])
+        HANDLER_POOL.submit(_drain_chat, chat_id)
+    return wrapper
+
+# Admin command arguments: "/Cmd[@bot] <id> [rest]". /Use takes a
+# payment transaction id, which is not numeric.
+_CMD_RE = re.compile(r"^/\w+(?:@\w+)?\s+(?P<id>\d+)(?:\s+(?P<rest>.+))?$", re.DOTALL)
+_CMD_TXID_RE = re.compile(r"^/\w+(?:@\w+)?\s+(?P<id>\S+)\s*$")
+
+def parse_command(message, usage, pattern=_CMD_RE, need_rest=False):
+    """Match a command's arguments, replying with usage when malformed"""
+    m = pattern.match(message.text or "")
+    if not m or (need_rest and not m["rest"]):
+        bot.reply_to(message, usage)
+        return None
+    return m
+
+def claim_pending(table, ids, status, stamp_column=None):
+    """Move rows that are still Pending to status and return the rows this
+    call claimed. The row status is the dedupe key: a row another pass (or
+    process) already claimed is simply not returned. With stamp_column the
+    claim also requires that column to be NULL and sets it to now."""
+    if not ids:
+        return []
+    changes = {"status": status}
+    if stamp_column:
+        changes[stamp_column] = datetime.now(timezone.utc).isoformat()
+    query = supabase.table(table).update(changes).in_("id", ids).eq("status", "Pending")
+    if stamp_column:
+        query = query.is_(stamp_column, "null")
+    return db_call(query, idempotent=False).data or []
 
 def poll_supportbox():
-    """Check SupportBox table every 10s for pending tickets"""
+    """Check SupportBox table for pending tickets, backing off while idle"""
+    idle = 0
     while True:
         try:
-            response = supabase.table("SupportBox").select("*").eq("status", "Pending").execute()
+            # Only ids are needed here; the claim returns the full rows
+            response = supabase.table("SupportBox").select("id").eq("status", "Pending").order("id").limit(POLL_BATCH).execute()
             rows = response.data or []
+            idle = 0 if rows else idle + 1
+            ids, texts = [], []
 
-            for row in rows:
+            # Claim before sending so a ticket is announced once
+            for row in claim_pending("SupportBox", [r["id"] for r in rows], "Sent"):
                 id_ = row.get("id")
-                if id_ in sent_ids:
-                    continue
-
                 email = row.get("email", "")
                 subject = row.get("subject", "Other")
                 message = row.get("message", "")
@@ -79,31 +184,34 @@ def poll_supportbox():
                     f"/Answer {id_} [reply message]\n"
                     f"/Close {id_}"
                 )
+                ids.append(id_)
+                texts.append(text)
 
-                try:
-                    bot.send_message(NEWS_GROUP_ID, text)
-                    supabase.table("SupportBox").update({"status": "Sent"}).eq("id", id_).execute()
-                    sent_ids.add(id_)
-                    print(f"[SENT] Ticket {id_} sent to group.")
-                except Exception as send_err:
-                    print(f"[ERROR] Sending message failed: {send_err}")
+            # One Telegram message for the whole batch where it fits
+            failed = [ids[i] for i in send_batch(NEWS_GROUP_ID, texts)]
+            if len(failed) < len(ids):
+                print(f"[SENT] {len(ids) - len(failed)} ticket(s) sent to group.")
+
+            # Put undelivered tickets back so the next pass retries them
+            if failed:
+                db_call(supabase.table("SupportBox").update({"status": "Pending"}).in_("id", failed))
 
         except Exception as e:
             print(f"[ERROR] Polling failed: {e}")
 
-        time.sleep(10)
+        time.sleep(idle_delay(idle))
 
 
 @bot.message_handler(commands=['Answer'])
+@pooled
 def handle_answer(message):
     try:
-        parts = message.text.split(' ', 2)
-        if len(parts) < 3:
-            bot.reply_to(message, "Usage: /Answer ID reply_message")
+        m = parse_command(message, "Usage: /Answer ID reply_message", need_rest=True)
+        if not m:
             return
 
-        id_ = int(parts[1])
-        reply_text = parts[2]
+        id_ = int(m["id"])
+        reply_text = m["rest"]
 
         supabase.table("SupportBox").update({
             "reply_text": reply_text,
@@ -121,14 +229,14 @@ def handle_answer(message):
 
 
 @bot.message_handler(commands=['Close'])
+@pooled
 def handle_close(message):
     try:
-        parts = message.text.split(' ', 1)
-        if len(parts) < 2:
-            bot.reply_to(message, "Usage: /Close ID")
+        m = parse_command(message, "Usage: /Close ID")
+        if not m:
             return
 
-        id_ = int(parts[1])
+        id_ = int(m["id"])
 
         supabase.table("SupportBox").update({
             "status": "Closed",
@@ -145,99 +253,119 @@ def handle_close(message):
 
 
 
-sent_ids = set()
-
 def update_user_balance(email, amount):
-    """Add USD balance to user"""
+    """Add USD balance to user (atomic, server-side)"""
+    amount = float(amount)
+    if not amount:
+        return True
     try:
-        # Get user
-        res = supabase.table("users").select("balance_usd").eq("email", email).execute()
-        if not res.data:
+        new_balance = db_call(supabase.rpc("add_balance", {"p_email": email, "p_amount": amount}), idempotent=False).data
+        if new_balance is None:
             print(f"[WARN] User not found: {email}")
             return False
 
-        current_balance = float(res.data[0]["balance_usd"] or 0)
-        new_balance = current_balance + float(amount)
-
-        supabase.table("users").update({"balance_usd": new_balance}).eq("email", email).execute()
-        print(f"[OK] Updated balance for {email}: {current_balance} → {new_balance}")
+        print(f"[OK] Updated balance for {email}: +{amount} → {new_balance}")
         return True
     except Exception as e:
         print(f"[ERROR] Balance update failed: {e}")
         return False
 
 
+_AFF_TOPUP_TPL = (
+    "💰 Affiliate Topup\n\n"
+    "🆔 ID = {id}\n"
+    "📧 Email = {email}\n"
+    "💳 Method = {method}\n"
+    "💵 Amount USD = {amount}\n"
+    "🇲🇲 Amount MMK = {mmk}"
+)
+
+_AFF_REQUEST_TPL = (
+    "🆕 New Affiliate Request\n\n"
+    "🆔 ID = {id}\n"
+    "📧 Email = {email}\n"
+    "💰 Amount = {amount}\n"
+    "💳 Method = {method}\n"
+    "📱 Phone ID = {phone_id}\n"
+    "👤 Name = {name}\n\n"
+    "🇲🇲 Amount MMK = {mmk}\n"
+    "🛠 Admin Actions:\n"
+    "/Accept {id}\n"
+    "/Failed {id}"
+)
+
 def poll_affiliate():
-    """Poll affiliate table for Pending entries every 10s"""
+    """Poll affiliate table for Pending entries, backing off while idle"""
+    idle = 0
     while True:
+        accepted = []
         try:
-            res = supabase.table("affiliate").select("*").eq("status", "Pending").execute()
+            res = supabase.table("affiliate").select("id").eq("status", "Pending").order("id").limit(POLL_BATCH).execute()
             rows = res.data or []
+            idle = 0 if rows else idle + 1
+
+            # First mark the whole batch as processing
+            rows = claim_pending("affiliate", [row["id"] for row in rows], "Processing")
+            # Notices go out after the loop; requests (not credited topups)
+            # are put back to Pending if their notice cannot be delivered
+            messages, notice_ids, request_ids = [], [], set()
 
             for row in rows:
                 aff_id = row["id"]
-                if aff_id in sent_ids:
-                    continue
-
                 email = row["email"]
                 amount = float(row["amount"])
                 method = row["method"]
-                phone_id = row.get("phone_id") or "-"
-                name = row.get("name") or "-"
-
-                # First mark as processing
-                supabase.table("affiliate").update({"status": "Processing"}).eq("id", aff_id).execute()
+                fields = {
+                    "id": aff_id, "email": email, "method": method, "amount": amount,
+                    "phone_id": row.get("phone_id") or "-", "name": row.get("name") or "-",
+                    "mmk": _FMT_MMK(amount * USD_TO_MMK),
+                }
 
                 if method.lower() == "topup":
                     ok = update_user_balance(email, amount)
                     if ok:
-                        supabase.table("affiliate").update({"status": "Accepted"}).eq("id", aff_id).execute()
-
-                        msg = (
-                            "💰 Affiliate Topup\n\n"
-                            f"🆔 ID = {aff_id}\n"
-                            f"📧 Email = {email}\n"
-                            f"💳 Method = {method}\n"
-                            f"💵 Amount USD = {amount}\n"
-                            f"🇲🇲 Amount MMK = {amount * USD_TO_MMK:,.0f}"
-                        )
-                        bot.send_message(GROUP_ID, msg)
+                        accepted.append(aff_id)
+                        messages.append(_AFF_TOPUP_TPL.format_map(fields))
+                        notice_ids.append(aff_id)
                         print(f"[TopUp] Accepted ID {aff_id} for {email}")
                 else:
-                    msg = (
-                        "🆕 New Affiliate Request\n\n"
-                        f"🆔 ID = {aff_id}\n"
-                        f"📧 Email = {email}\n"
-                        f"💰 Amount = {amount}\n"
-                        f"💳 Method = {method}\n"
-                        f"📱 Phone ID = {phone_id}\n"
-                        f"👤 Name = {name}\n\n"
-                        f"🇲🇲 Amount MMK = {amount * USD_TO_MMK:,.0f}\n"
-                        "🛠 Admin Actions:\n"
-                        f"/Accept {aff_id}\n"
-                        f"/Failed {aff_id}"
-                    )
-                    bot.send_message(GROUP_ID, msg)
+                    messages.append(_AFF_REQUEST_TPL.format_map(fields))
+                    notice_ids.append(aff_id)
+                    request_ids.add(aff_id)
                     print(f"[Request] New Affiliate Request ID {aff_id}")
 
-                sent_ids.add(aff_id)
+            # These rows are already claimed; send inline so the notice
+            # cannot be lost in the queue
+            failed = [notice_ids[i] for i in send_batch(GROUP_ID, messages)]
+            if failed:
+                print(f"[ERROR] Affiliate notices not delivered for IDs {failed}")
+                retry = [aff_id for aff_id in failed if aff_id in request_ids]
+                if retry:
+                    db_call(supabase.table("affiliate").update({"status": "Pending"}).in_("id", retry).eq("status", "Processing"))
 
         except Exception as e:
             print(f"[ERROR] Polling affiliate failed: {e}")
+        finally:
+            # Credited topups are marked Accepted even if a later send failed
+            if accepted:
+                try:
+                    db_call(supabase.table("affiliate").update({"status": "Accepted"}).in_("id", accepted))
+                except Exception as e:
+                    print(f"[ERROR] Accepting affiliate topups failed: {e}")
 
-        time.sleep(10)
+        time.sleep(idle_delay(idle))
 
 
 @bot.message_handler(commands=['Accept'])
+@pooled
 def handle_accept(message):
     try:
-        parts = message.text.split(' ', 1)
-        if len(parts) < 2:
-            bot.reply_to(message, "Usage: /Accept ID")
+        m = parse_command(message, "Usage: /Accept ID")
+        if not m:
             return
 
-        aff_id = int(parts[1])
-        res = supabase.table("affiliate").select("*").eq("id", aff_id).execute()
+        aff_id = int(m["id"])
+        res = supabase.table("affiliate").select("email,amount").eq("id", aff_id).execute()
         if not res.data:
             bot.reply_to(message, "Affiliate ID not found.")
             return
@@ -259,14 +387,14 @@ def handle_accept(message):
 
 
 @bot.message_handler(commands=['Failed'])
+@pooled
 def handle_failed(message):
     try:
-        parts = message.text.split(' ', 1)
-        if len(parts) < 2:
-            bot.reply_to(message, "Usage: /Failed ID")
+        m = parse_command(message, "Usage: /Failed ID")
+        if not m:
             return
 
-        aff_id = int(parts[1])
+        aff_id = int(m["id"])
         supabase.table("affiliate").update({"status": "Failed"}).eq("id", aff_id).execute()
         bot.reply_to(message, f"❌ Failed ID {aff_id}")
         print(f"[Fail] ID {aff_id} marked as failed.")
@@ -277,13 +405,19 @@ def handle_failed(message):
 
 
 
-USD_TO_MMK = 4500
 POLL_INTERVAL = 10  # seconds
+POLL_MAX_INTERVAL = 30  # seconds, ceiling while a table stays idle
+POLL_BATCH = 100  # rows claimed per pass; the rest wait for the next pass
+
+
+def idle_delay(idle_passes, base=POLL_INTERVAL, ceiling=POLL_MAX_INTERVAL):
+    """Sleep before the next poll, doubling per consecutive empty pass"""
+    return min(ceiling, base * 2 ** min(idle_passes, 6))
 
 # =================================
 # INITIAL SETUP
 # ================================
-processed_ids = set()
+TX_POOL = ThreadPoolExecutor(max_workers=8)
 
 
 # =================================
@@ -297,109 +431,150 @@ def update_verify_status(txid, status):
     supabase.table("VerifyPayment").update({"status": status}).eq("transaction_id", txid).execute()
 
 
-def update_user_balance(email, amount):
-    user = supabase.table("users").select("balance_usd").eq("email", email).single().execute()
-    if user.data:
-        old_balance = float(user.data["balance_usd"])
-        new_balance = old_balance + float(amount)
-        supabase.table("users").update({"balance_usd": new_balance}).eq("email", email).execute()
-        return True
-    return False
+_AUTO_TOPUP_TPL = (
+    "✅ Auto Top-up Completed\n\n"
+    "👤 User: {email}\n"
+    "💳 Method: {method}\n"
+    "💰 Amount USD: {amount}\n"
+    "🇲🇲 Amount MMK: {mmk}\n"
+    "🧾 Transaction ID: {txid}"
+)
+
+_UNVERIFIED_TPL = (
+    "🆕 New Unverified Transaction\n\n"
+    "🆔 ID: {id}\n"
+    "📧 Email: {email}\n"
+    "💳 Method: {method}\n"
+    "💵 Amount USD: {amount}\n"
+    "🇲🇲 Amount MMK: {mmk}\n"
+    "🧾 Transaction ID: {txid}\n\n"
+    "🛠 Admin Commands:\n"
+    "/Yes {id}\n"
+    "/No {id}"
+)
+
+
+def format_auto_topup_message(email, method, amount, txid):
+    return _AUTO_TOPUP_TPL.format_map({
+        "email": email, "method": method, "amount": amount,
+        "mmk": _FMT_MMK(amount * USD_TO_MMK), "txid": txid,
+    })
+
+
+def format_unverified_tx_message(tx_db_id, email, method, amount, txid):
+    return _UNVERIFIED_TPL.format_map({
+        "id": tx_db_id, "email": email, "method": method, "amount": amount,
+        "mmk": _FMT_MMK(amount * USD_TO_MMK), "txid": txid,
+    })
+
+
+def handle_transaction(tx, candidates):
+    """Verify one claimed transaction against its unused VerifyPayment rows.
+    Returns the admin notification for it; anything that cannot be verified
+    automatically comes back as the unverified /Yes /No message."""
+    txid = tx.get("transaction_id")
+    email = tx.get("email")
+    method = tx.get("method")
+    amount = float(tx.get("amount") or 0)
+    tx_db_id = tx.get("id")
+
+    try:
+        match = None
+        for v in candidates:
+            if v.get("method") == method and abs(float(v["amount_usd"]) - amount) < 0.0001:
+                match = v
+                break
+
+        # Use the VerifyPayment row, accept the tx and credit the user in
+        # one transaction; false means a concurrent worker already used the
+        # payment or the user could not be credited
+        if match:
+            try:
+                finalized = db_call(supabase.rpc("finalize_tx", {"p_vp_id": match["id"], "p_tx_id": tx_db_id}), idempotent=False)
+            except Exception as e:
+                # The row is already claimed and will not be polled again,
+                # so hand it to the admins rather than leave it stuck
+                print(f"[ERROR] finalize_tx for transaction {tx_db_id} failed: {e}")
+                return format_unverified_tx_message(tx_db_id, email, method, amount, txid)
+            if not finalized.data:
+                match = None
+
+        # CASE 1: Auto Verified
+        if match:
+            return format_auto_topup_message(email, method, amount, txid)
+
+        # CASE 2: Unverified
+        return format_unverified_tx_message(tx_db_id, email, method, amount, txid)
+
+    except Exception as e:
+        print(f"[ERROR] Transaction {tx_db_id} failed: {e}")
+        return format_unverified_tx_message(tx_db_id, email, method, amount, txid)
 
 
 # =================================
 # POLLING LOOP
 # =================================
 def poll_transactions():
+    idle = 0
     while True:
         try:
-            result = supabase.table("transactions").select("*").eq("status", "Pending").execute()
+            # Same filter as the claim, so rows reset to Pending by hand
+            # without clearing processed_at cannot hog the batch
+            result = supabase.table("transactions").select("id").eq("status", "Pending").is_("processed_at", "null").order("id").limit(POLL_BATCH).execute()
             transactions = result.data or []
-
-            for tx in transactions:
-                txid = tx.get("transaction_id")
-                email = tx.get("email")
-                method = tx.get("method")
-                amount = float(tx.get("amount") or 0)
-                tx_db_id = tx.get("id")
-
-                if tx_db_id in processed_ids:
-                    continue
-
-                # Mark as processing
-                update_transaction_status(tx_db_id, "Processing")
-                processed_ids.add(tx_db_id)
-
-                # Find matching VerifyPayment
-                verify = (
+            idle = 0 if transactions else idle + 1
+
+            # Claim the whole batch and fetch every candidate payment in
+            # two round-trips instead of two per transaction
+            claimed = claim_pending("transactions", [tx["id"] for tx in transactions], "Processing", stamp_column="processed_at")
+            if claimed:
+                txids = list({tx.get("transaction_id") for tx in claimed if tx.get("transaction_id")})
+                verify = db_call(
                     supabase.table("VerifyPayment")
-                    .select("*")
-                    .eq("transaction_id", txid)
-                    .eq("method", method)
+                    .select("id,transaction_id,method,amount_usd")
+                    .in_("transaction_id", txids)
                     .eq("status", "unused")
-                    .execute()
-                )
-
-                match = None
-                if verify.data:
-                    for v in verify.data:
-                        if abs(float(v["amount_usd"]) - amount) < 0.0001:
-                            match = v
-                            break
-
-                # CASE 1: Auto Verified
-                if match:
-                    update_verify_status(txid, "used")
-                    update_user_balance(email, amount)
-                    update_transaction_status(tx_db_id, "Accepted")
-
-                    mmk = amount * USD_TO_MMK
-                    message = (
-                        "✅ Auto Top-up Completed\n\n"
-                        + f"👤 User: {email}\n"
-                        + f"💳 Method: {method}\n"
-                        + f"💰 Amount USD: {amount}\n"
-                        + f"🇲🇲 Amount MMK: {mmk:,.0f}\n"
-                        + f"🧾 Transaction ID: {txid}"
+                ).data if txids else []
+                vp_by_txid = defaultdict(list)
+                for v in verify or []:
+                    vp_by_txid[v.get("transaction_id")].append(v)
+
+                # finalize_tx stays per transaction so each credit is atomic;
+                # those calls are independent network I/O, so overlap them
+                candidates = [vp_by_txid.get(tx.get("transaction_id"), []) for tx in claimed]
+                results = TX_POOL.map(handle_transaction, claimed, candidates)
+                notices = [(tx["id"], m) for tx, m in zip(claimed, results) if m]
+                # Claimed rows are never polled again, so this is the only
+                # notice; send it inline rather than through the queue
+                failed = [notices[i][0] for i in send_batch(GROUP_ID, [m for _, m in notices])]
+                if failed:
+                    # Unverified ones are still Processing: un-claim them so
+                    # the next pass retries. Accepted ones are already credited.
+                    print(f"[ERROR] Transaction notices not delivered for IDs {failed}")
+                    db_call(
+                        supabase.table("transactions")
+                        .update({"status": "Pending", "processed_at": None})
+                        .in_("id", failed)
+                        .eq("status", "Processing")
                     )
-                    bot.send_message(GROUP_ID, message)
-
-                # CASE 2: Unverified
-                else:
-                    mmk = amount * USD_TO_MMK
-                    message = (
-                        "🆕 New Unverified Transaction\n\n"
-                        + f"🆔 ID: {tx_db_id}\n"
-                        + f"📧 Email: {email}\n"
-                        + f"💳 Method: {method}\n"
-                        + f"💵 Amount USD: {amount}\n"
-                        + f"🇲🇲 Amount MMK: {mmk:,.0f}\n"
-                        + f"🧾 Transaction ID: {txid}\n\n"
-                        + "🛠 Admin Commands:\n"
-                        + f"/Yes {tx_db_id}\n"
-                        + f"/No {tx_db_id}"
-                    )
-                    bot.send_message(GROUP_ID, message)
 
         except Exception as e:
             print("Polling Error:", e)
 
-        time.sleep(POLL_INTERVAL)
+        time.sleep(idle_delay(idle))
 
 
 # =================================
 # ADMIN COMMANDS
 # =================================
-@bot.message_handler(commands=["Yes"])
 def yes_command(message):
     try:
-        parts = message.text.split()
-        if len(parts) < 2:
-            bot.reply_to(message, "Usage: /Yes ID")
+        m = parse_command(message, "Usage: /Yes ID")
+        if not m:
             return
 
-        tx_id = int(parts[1])
-        data = supabase.table("transactions").select("*").eq("id", tx_id).single().execute().data
+        tx_id = int(m["id"])
+        data = supabase.table("transactions").select("email,amount").eq("id", tx_id).single().execute().data
 
         if not data:
             bot.reply_to(message, "Transaction not found.")
@@ -415,30 +590,26 @@ def yes_command(message):
         bot.reply_to(message, f"Error: {e}")
 
 
-@bot.message_handler(commands=["No"])
 def no_command(message):
     try:
-        parts = message.text.split()
-        if len(parts) < 2:
-            bot.reply_to(message, "Usage: /No ID")
+        m = parse_command(message, "Usage: /No ID")
+        if not m:
             return
 
-        tx_id = int(parts[1])
+        tx_id = int(m["id"])
         update_transaction_status(tx_id, "Failed")
         bot.reply_to(message, f"Transaction #{tx_id} marked as Failed.")
     except Exception as e:
         bot.reply_to(message, f"Error: {e}")
 
 
-@bot.message_handler(commands=["Use"])
 def use_command(message):
     try:
-        parts = message.text.split()
-        if len(parts) < 2:
-            bot.reply_to(message, "Usage: /Use TransactionID")
+        m = parse_command(message, "Usage: /Use TransactionID", pattern=_CMD_TXID_RE)
+        if not m:
             return
 
-        txid = parts[1]
+        txid = m["id"]
         update_verify_status(txid, "used")
         bot.reply_to(message, f"VerifyPayment {txid} marked as used.")
     except Exception as e:
@@ -453,7 +624,8 @@ def use_command(message):
 # ---------------------------
 # WEBSITE ORDERS + SMMGEN
 # ---------------------------
-_escape_re = re.compile(r'([_*[\]()~`>#+\-=|{}.!])')
+# MarkdownV2 reserved characters, backslash included
+_MD_ESCAPE_TABLE = str.maketrans({c: "\\" + c for c in "_*[]()~`>#+-=|{}.!\\"})
 
 def now_yangon():
     return datetime.now(TZ)
@@ -464,77 +636,204 @@ def iso_now():
 def escape_markdown(text: str) -> str:
     if text is None:
         return ""
-    return _escape_re.sub(r'\\\1', str(text))
+    return str(text).translate(_MD_ESCAPE_TABLE)
 
 def try_parse_iso(s):
+    if not s:
+        return None
     try:
-        return dateutil.parser.isoparse(s) if s else None
-    except Exception:
+        # Supabase timestamps are strict ISO 8601; "Z" needs mapping before 3.11
+        return datetime.fromisoformat(s.replace("Z", "+00:00"))
+    except (AttributeError, TypeError, ValueError):
         return None
 
 def is_transient_exception(e: Exception) -> bool:
     name = type(e).__name__
     msg = str(e).lower()
-    if isinstance(e, requests.exceptions.RequestException):
+    if isinstance(e, (requests.exceptions.RequestException, httpx.TransportError)):
         return True
     for k in ("connection reset", "broken pipe", "connection aborted", "timed out", "timeout", "remote protocol error"):
         if k in msg:
             return True
     return False
 
-def safe_execute(func, retries=5, base_delay=0.5, *args, **kwargs):
-    last_exc = None
+def is_unsent_exception(e: Exception) -> bool:
+    """True when the request provably never reached the server"""
+    return isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+def db_call(builder, retries=3, base_delay=0.1, max_delay=2, idempotent=True):
+    """Execute a Supabase query builder, retrying transient network errors.
+    Non-idempotent writes (money RPCs, conditional claims) pass
+    idempotent=False: a read timeout may arrive after the write committed,
+    so those are only retried when the request never left."""
+    retryable = is_transient_exception if idempotent else is_unsent_exception
     for attempt in range(retries):
         try:
-            return func(*args, **kwargs)
+            return builder.execute()
         except Exception as e:
-            last_exc = e
-            if is_transient_exception(e):
-                delay = base_delay * (2 ** attempt)
-                print(f"[safe_execute] transient error ({e}), retrying in {delay:.2f}s (attempt {attempt+1}/{retries})")
+            if retryable(e) and attempt + 1 < retries:
+                # Jittered so threads hitting the same outage don't retry in lockstep
+                delay = min(max_delay, base_delay * (2 ** attempt)) * (1 + random.random() * 0.5)
+                print(f"[db_call] transient error ({e}), retrying in {delay:.2f}s (attempt {attempt+1}/{retries})")
                 time.sleep(delay)
                 continue
-            else:
-                raise
-    print(f"[safe_execute] operation failed after {retries} attempts: {last_exc}")
-    raise last_exc
+            raise
+
+def chunks(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
 
 def safe_request(method, url, retries=3, timeout=25, **kwargs):
     last_exc = None
     for attempt in range(retries):
         try:
-            r = requests.request(method, url, timeout=timeout, **kwargs)
+            r = smmgen_session.request(method, url, timeout=timeout, **kwargs)
             r.raise_for_status()
             return r
         except Exception as e:
             last_exc = e
             if is_transient_exception(e) and attempt + 1 < retries:
-                delay = 1 + attempt * 2
-                print(f"[safe_request] transient {e}, retrying in {delay}s (attempt {attempt+1}/{retries})")
+                delay = min(30, 2 ** attempt) * (1 + random.random() * 0.5)
+                print(f"[safe_request] transient {e}, retrying in {delay:.2f}s (attempt {attempt+1}/{retries})")
                 time.sleep(delay)
                 continue
             else:
                 raise
     raise last_exc
 
-def safe_send(chat_id, text, parse_mode=None):
-    """Safely send Telegram messages with optional Markdown/HTML formatting"""
-    try:
-        if parse_mode:
-            bot.send_message(chat_id, text, parse_mode=parse_mode)
-        else:
-            bot.send_message(chat_id, text)
-    except Exception as e:
-        print("Telegram send error:", e)
-
-USD_TO_MMK = 4500  # MMK conversion rate
+TG_MAX_MESSAGE = 4000  # Telegram rejects messages over 4096 characters
+
+TG_SEND_RETRIES = 3
+
+# parse_mode for user-supplied text: telebot then sends no parse_mode at
+# all, overriding the bot's Markdown default that rejects a stray "_" or "*"
+PLAIN_TEXT = ""
+
+def send_now(chat_id, text, parse_mode=None):
+    """Send a Telegram message on the calling thread with optional
+    Markdown/HTML formatting (None means the bot default), split into TG_MAX_MESSAGE-sized parts and
+    retried on 429/transient errors. Returns False if any part failed."""
+    ok = True
+    for i in range(0, len(text), TG_MAX_MESSAGE):
+        part = text[i:i + TG_MAX_MESSAGE]
+        for attempt in range(TG_SEND_RETRIES):
+            try:
+                bot.send_message(chat_id, part, parse_mode=parse_mode)
+                break
+            except Exception as e:
+                if attempt + 1 < TG_SEND_RETRIES:
+                    if isinstance(e, apihelper.ApiTelegramException) and e.error_code == 429:
+                        time.sleep((e.result_json or {}).get("parameters", {}).get("retry_after", 1))
+                        continue
+                    if is_transient_exception(e):
+                        time.sleep(2 ** attempt)
+                        continue
+                ok = False
+                print("Telegram send error:", e)
+                break
+    return ok
+
+MESSAGE_SEPARATOR = "\n\n━━━━━━━\n\n"
+
+def batch_messages(texts):
+    """Pack texts into as few messages as fit in TG_MAX_MESSAGE, never
+    splitting one text across two. Yields (indexes, combined_text)."""
+    group, size = [], 0
+    for i, text in enumerate(texts):
+        extra = len(text) + (len(MESSAGE_SEPARATOR) if group else 0)
+        if group and size + extra > TG_MAX_MESSAGE:
+            yield group, MESSAGE_SEPARATOR.join(texts[j] for j in group)
+            group, size, extra = [], 0, len(text)
+        group.append(i)
+        size += extra
+    if group:
+        yield group, MESSAGE_SEPARATOR.join(texts[j] for j in group)
+
+def send_batch(chat_id, texts, parse_mode=PLAIN_TEXT):
+    """Send texts as combined messages, as plain text unless told otherwise;
+    returns the indexes not delivered"""
+    failed = []
+    for indexes, combined in batch_messages(texts):
+        if send_now(chat_id, combined, parse_mode):
+            continue
+        if len(indexes) == 1:
+            failed.extend(indexes)
+            continue
+        # Resend one by one so a single bad text only fails itself
+        for i in indexes:
+            if not send_now(chat_id, texts[i], parse_mode):
+                failed.append(i)
+    return failed
+
+# Telegram sends queued here are delivered by TG_WORKERS _tg_worker
+# threads, so a slow Telegram API does not stall the thread that
+# produced the message. Each chat is pinned to one worker's queue, so
+# notices to the same chat (e.g. refund, referral and "Status Changed"
+# for one order) arrive in the order they were queued.
+TG_WORKERS = 4
+_tg_queues = [queue.Queue(maxsize=512) for _ in range(TG_WORKERS)]
+
+def _tg_worker(index):
+    q = _tg_queues[index]
+    while True:
+        chat_id, text, parse_mode = q.get()
+        try:
+            send_now(chat_id, text, parse_mode=parse_mode)
+        except Exception:
+            traceback.print_exc()
 
 def safe_send(chat_id, text, parse_mode=None):
+    """Queue a Telegram message for its chat's send worker; waits for room
+    if that queue is full, so nothing is dropped or reordered. Queued
+    messages are lost on shutdown, so use send_now or send_batch for
+    notices that nothing else will repeat."""
+    q = _tg_queues[hash(chat_id) % TG_WORKERS]
     try:
-        bot.send_message(chat_id, text, parse_mode=parse_mode)
-    except Exception as e:
-        print("safe_send error:", e)
+        q.put_nowait((chat_id, text, parse_mode))
+    except queue.Full:
+        print(f"Telegram queue full, waiting to queue for {chat_id}")
+        q.put((chat_id, text, parse_mode))
+
+
+# action=add is paid and not idempotent, so it is only retried when SMMGEN
+# provably never took the order: the connection was never made, or 429.
+# Read timeouts, 5xx and unparseable bodies may mean the order was placed.
+def is_retryable_smmgen_error(e):
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and e.response.status_code in SMMGEN_RETRY_STATUSES
+    return isinstance(e, requests.exceptions.ConnectionError)
+
+def is_rejected_smmgen_error(e):
+    """True when SMMGEN certainly did not place the order"""
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and 400 <= e.response.status_code < 500
+    return is_retryable_smmgen_error(e)
+
+def _cancel_order_with_notify(order, attempts, title, detail):
+    """Cancel an order SMMGEN would not take, reverse its counters and tell the supplier group"""
+    db_call(
+        supabase.table("WebsiteOrders")
+        .update({
+            "status": "Canceled",
+            "supplier_order_id": "123456",
+            "smmgen_attempts": attempts
+        })
+        .eq("id", order["id"])
+    )
 
+    try:
+        adjust_service_qty_on_status_change(order, order.get("status"), "Canceled")
+    except Exception as err:
+        print("adjust_service_qty_on_status_change error:", err)
+
+    safe_send(
+        SUPPLIER_GROUP_ID,
+        f"{title}\n"
+        f"🆔 {order.get('id')}\n"
+        f"📧 {order.get('email')}\n"
+        f"{detail}",
+        parse_mode=PLAIN_TEXT
+    )
 
 def send_to_smmgen(order):
     """Send order to SMMGEN API and handle response/errors safely"""
@@ -553,85 +852,172 @@ def send_to_smmgen(order):
         # comments မရှိရင်တော့ quantity သုံး
         payload["quantity"] = order.get("quantity")
 
-    try:
-        r = safe_request("POST", SMMGEN_URL, data=payload, timeout=20)
-        data = r.json()
-    except Exception as e:
-        print("send_to_smmgen request error:", e)
-
-        # Mark as canceled
-        safe_execute(
-            lambda: supabase.table("WebsiteOrders")
-            .update({
-                "status": "Canceled",
-                "supplier_order_id": "123456"
-            })
-            .eq("id", order["id"])
-            .execute()
-        )
+    data = None
+    error = None
+    attempts = 0
 
-        # Adjust service quantity
+    # Failures before SMMGEN took the order are retried with jittered
+    # backoff and cancel the order once exhausted; anything else leaves the
+    # outcome unknown and is handed to the admins.
+    for attempt in range(SMMGEN_ADD_RETRIES):
+        attempts = attempt + 1
         try:
-            adjust_service_qty_on_status_change(order, order.get("status"), "Canceled")
-        except Exception as err:
-            print("adjust_service_qty_on_status_change error:", err)
-
-        # Notify supplier group
-        safe_send(
+            r = smmgen_session.post(SMMGEN_URL, data=payload, timeout=20)
+            r.raise_for_status()
+            data = orjson.loads(r.content)
+            break
+        except Exception as e:
+            if is_retryable_smmgen_error(e) and attempts < SMMGEN_ADD_RETRIES:
+                delay = min(30, (2 ** attempt) * (1 + random.random() * 0.5))
+                print(f"send_to_smmgen transient error ({e}), retrying in {delay:.2f}s (attempt {attempts}/{SMMGEN_ADD_RETRIES})")
+                time.sleep(delay)
+                continue
+            error = e
+            break
+
+    if error is not None and not is_rejected_smmgen_error(error):
+        # The order may exist at SMMGEN; it stays Processing without a
+        # supplier_order_id until someone checks the SMMGEN panel
+        print("send_to_smmgen outcome unknown:", error)
+        send_now(
             SUPPLIER_GROUP_ID,
-            f"❌ SMMGEN API Request Failed\n"
+            f"❓ SMMGEN Order Outcome Unknown\n"
             f"🆔 {order.get('id')}\n"
             f"📧 {order.get('email')}\n"
-            f"⚠️ Error: {str(e)}",
-            parse_mode="HTML"
+            f"⚠️ Error: {str(error)}\n"
+            f"Check the SMMGEN panel before resending or refunding this order.",
+            parse_mode=PLAIN_TEXT
         )
+        return {"success": False, "unknown": True, "error": str(error), "attempts": attempts}
 
-        return {"success": False, "error": str(e)}
+    if error is not None:
+        print("send_to_smmgen request error:", error)
+
+        _cancel_order_with_notify(order, attempts, "❌ SMMGEN API Request Failed", f"⚠️ Error: {str(error)}")
+        return {"success": False, "error": str(error), "attempts": attempts}
 
     # ✅ Response check
     if isinstance(data, dict) and "order" in data:
-        return {"success": True, "order_id": data["order"]}
+        return {"success": True, "order_id": data["order"], "attempts": attempts}
     else:
         print("send_to_smmgen response error:", data)
 
-        # Update to canceled
-        safe_execute(
-            lambda: supabase.table("WebsiteOrders")
+        _cancel_order_with_notify(order, attempts, "⚠️ SMMGEN API Response Error", f"📩 Response: {orjson.dumps(data).decode()}")
+        return {"success": False, "error": data, "attempts": attempts}
+
+ORDER_COLUMNS = (
+    "id,status,supplier_name,supplier_order_id,supplier_service_id,email,service,"
+    "quantity,remain,link,comments,sell_charge,day,created_at,UsedType"
+)
+
+def flush_order_updates(processing_ids):
+    """Write the K2BOOST status changes collected during one orders pass"""
+    if processing_ids:
+        db_call(
+            supabase.table("WebsiteOrders")
+            .update({"status": "Processing"})
+            .in_("id", processing_ids)
+        )
+
+_SMMGEN_ORDER_TPL = (
+    "🚀 New Order Sent to SMMGEN\n\n"
+    "🆔 {id}\n"
+    "📦 Service: {service}\n"
+    "🔢 Quantity: {quantity}\n"
+    "🔗 Link: {link}\n"
+    "💰 Sell Charge (USD): {sell_charge}\n"
+    "💵 Sell Charge (MMK): {sell_mmk}\n"
+    "📧 Email: {email}\n"
+    "🧾 Supplier Order ID: {supplier_order_id}\n"
+    "✅ Status: Processing"
+)
+
+_K2BOOST_ORDER_TPL = (
+    "⚡️ New Order to K2BOOST\n\n"
+    "🆔 {id}\n"
+    "📧 Email: {email}\n"
+    "📦 Service: {service}\n"
+    "🔢 Quantity: {quantity}\n"
+    "🔗 Link: {link}\n"
+    "📆 Day: {day}\n"
+    "⏳ Remain: {remain}\n"
+    "💰 Sell Charge (USD): {sell_charge}\n"
+    "💵 Sell Charge (MMK): {sell_mmk}\n"
+    "🏷 Supplier: {supplier_name}\n"
+    "🕒 Created: {created_at}\n"
+    "💬 Used Type: {UsedType}"
+)
+
+def format_order_msg(template, o, **extra):
+    """Fill an order template from the row; missing fields render as '-'"""
+    fields = defaultdict(lambda: "-", o)
+    fields["sell_mmk"] = _FMT_MMK(float(o.get("sell_charge") or 0) * USD_TO_MMK)
+    fields.update(extra)
+    return template.format_map(fields)
+
+def store_smmgen_order_id(o, result):
+    """Save the supplier_order_id of an order SMMGEN accepted. The status
+    poll only sees orders that have one, so a failed write is escalated."""
+    try:
+        db_call(
+            supabase.table("WebsiteOrders")
             .update({
-                "status": "Canceled",
-                "supplier_order_id": "123456"
+                "supplier_order_id": str(result["order_id"]),
+                "smmgen_attempts": result["attempts"]
             })
-            .eq("id", order["id"])
-            .execute()
+            .eq("id", o["id"])
         )
-
-        try:
-            adjust_service_qty_on_status_change(order, order.get("status"), "Canceled")
-        except Exception as err:
-            print("adjust_service_qty_on_status_change error:", err)
-
-        safe_send(
+    except Exception as e:
+        print(f"Order {o['id']}: storing SMMGEN order {result['order_id']} failed:", e)
+        send_now(
             SUPPLIER_GROUP_ID,
-            f"⚠️ SMMGEN API Response Error\n"
-            f"🆔 {order.get('id')}\n"
-            f"📧 {order.get('email')}\n"
-            f"📩 Response: {json.dumps(data, ensure_ascii=False)}",
-            parse_mode="HTML"
+            f"⚠️ SMMGEN Order Not Saved\n"
+            f"🆔 {o['id']}\n"
+            f"🧾 Supplier Order ID: {result['order_id']}\n"
+            f"Set supplier_order_id on this order by hand; it will not be status-polled until then.",
+            parse_mode=PLAIN_TEXT
+        )
+
+def release_unsent_orders(ids):
+    """Put claimed SMMGEN orders that were never sent back to Pending"""
+    if ids:
+        db_call(
+            supabase.table("WebsiteOrders")
+            .update({"status": "Pending"})
+            .in_("id", list(ids))
+            .eq("status", "Processing")
+            .is_("supplier_order_id", "null")
         )
 
-        return {"success": False, "error": data}
+# Incremental passes only read orders newer than the last id seen; a full
+# sweep of Pending every ORDERS_FULL_SWEEP seconds catches stragglers
+# (late-committed inserts, orders left Pending after an error).
+ORDERS_FULL_SWEEP = 300
 
 def check_new_orders_loop():
+    idle = 0
+    last_seen_id = None
+    last_full_sweep = 0.0
     while True:
+        processing_ids = []
+        unsent = set()
         try:
-            res = safe_execute(
-                lambda: supabase.table("WebsiteOrders")
-                .select("*")
+            query = (
+                supabase.table("WebsiteOrders")
+                .select(ORDER_COLUMNS)
                 .eq("status", "Pending")
-                .execute()
+                .order("id")
             )
-            orders = res.data or []
+            if last_seen_id is not None and time.monotonic() - last_full_sweep < ORDERS_FULL_SWEEP:
+                query = query.gt("id", last_seen_id)
+            else:
+                last_full_sweep = time.monotonic()
+            orders = db_call(query).data or []
+            if orders:
+                last_seen_id = max(last_seen_id or 0, orders[-1]["id"])
+            idle = 0 if orders else idle + 1
 
+            dispatch = []
             for o in orders:
                 status = (o.get("status") or "").lower()
                 supplier_order_id = o.get("supplier_order_id")
@@ -645,73 +1031,67 @@ def check_new_orders_loop():
                 if supplier_name == "smmgen" and supplier_order_id not in [None, "", 0, "0"]:
                     continue
 
-                # ✅ smmgen orders
-                if supplier_name == "smmgen":
-                    result = send_to_smmgen(o)
-                    if result.get("success"):
-                        safe_execute(lambda: supabase.table("WebsiteOrders")
-                            .update({
-                                "status": "Processing",
-                                "supplier_order_id": str(result["order_id"])
-                            })
-                            .eq("id", o["id"])
-                            .execute()
-                        )
-                        msg = (
-                            f"🚀 New Order Sent to SMMGEN\n\n"
-                            f"🆔 {o.get('id')}\n"
-                            f"📦 Service: {o.get('service')}\n"
-                            f"🔢 Quantity: {o.get('quantity')}\n"
-                            f"🔗 Link: {o.get('link')}\n"
-                            f"💰 Sell Charge (USD): {o.get('sell_charge')}\n"
-                            f"💵 Sell Charge (MMK): {o.get('sell_charge') * USD_TO_MMK:,.0f}\n"
-                            f"📧 Email: {o.get('email')}\n"
-                            f"🧾 Supplier Order ID: {result['order_id']}\n"
-                            f"✅ Status: Processing"
-                        )
-                        safe_send(SUPPLIER_GROUP_ID, msg, parse_mode="HTML")
-
-                # ✅ K2BOOST orders
-                elif supplier_name == "k2boost":
-                    msg = (
-                        f"⚡️ New Order to K2BOOST\n\n"
-                        f"🆔 {o.get('id')}\n"
-                        f"📧 Email: {o.get('email')}\n"
-                        f"📦 Service: {o.get('service')}\n"
-                        f"🔢 Quantity: {o.get('quantity')}\n"
-                        f"🔗 Link: {o.get('link')}\n"
-                        f"📆 Day: {o.get('day')}\n"
-                        f"⏳ Remain: {o.get('remain')}\n"
-                        f"💰 Sell Charge (USD): {o.get('sell_charge')}\n"
-                        f"💵 Sell Charge (MMK): {o.get('sell_charge') * USD_TO_MMK:,.0f}\n"
-                        f"🏷 Supplier: {o.get('supplier_name')}\n"
-                        f"🕒 Created: {o.get('created_at')}\n"
-                        f"💬 Used Type: {o.get('UsedType')}"
-                    )
-                    safe_send(K2BOOST_GROUP_ID, msg, parse_mode="HTML")
-
-                    # Update order status
-                    safe_execute(
-                        lambda: supabase.table("WebsiteOrders")
-                        .update({"status": "Processing"})
-                        .eq("id", o["id"])
-                        .execute()
-                    )
+                dispatch.append((supplier_name, o))
+
+            # SMMGEN "add" is paid and not idempotent: claim the rows first so
+            # a later sweep (or another process) can never send them twice
+            claimed = {r["id"] for r in claim_pending(
+                "WebsiteOrders", [o["id"] for name, o in dispatch if name == "smmgen"], "Processing"
+            )}
+
+            # Claimed orders not yet handed to send_to_smmgen; put back to
+            # Pending at the end of the pass if something stops the loop
+            unsent = set(claimed)
+            for supplier_name, o in dispatch:
+                try:
+                    # ✅ smmgen orders
+                    if supplier_name == "smmgen":
+                        if o["id"] not in claimed:
+                            continue
+                        result = send_to_smmgen(o)
+                        unsent.discard(o["id"])
+                        if result.get("success"):
+                            store_smmgen_order_id(o, result)
+                            msg = format_order_msg(_SMMGEN_ORDER_TPL, o, supplier_order_id=result["order_id"])
+                            send_now(SUPPLIER_GROUP_ID, msg, parse_mode=PLAIN_TEXT)
+
+                    # ✅ K2BOOST orders
+                    elif supplier_name == "k2boost":
+                        msg = format_order_msg(_K2BOOST_ORDER_TPL, o)
+                        # The message is the dispatch: only an order whose
+                        # message went out moves on to Processing
+                        if send_now(K2BOOST_GROUP_ID, msg, parse_mode=PLAIN_TEXT):
+                            processing_ids.append(o["id"])
+                except Exception as e:
+                    print(f"check_new_orders_loop: order {o.get('id')} failed:", e)
+                    traceback.print_exc()
 
         except Exception as e:
             print("check_new_orders_loop error:", e)
             traceback.print_exc()
-            time.sleep(3)
+        finally:
+            # Flush even after an error so notified orders are not resent
+            try:
+                flush_order_updates(processing_ids)
+            except Exception as e:
+                print("flush_order_updates error:", e)
+                traceback.print_exc()
+            try:
+                release_unsent_orders(unsent)
+            except Exception as e:
+                print("release_unsent_orders error:", e)
+                traceback.print_exc()
+
+        time.sleep(idle_delay(idle))
 
 
-@bot.message_handler(commands=['D'])
 def admin_mark_completed(message):
     try:
-        parts = message.text.split()
-        if len(parts) < 2:
-            return bot.reply_to(message, "Usage: /D <OrderID>")
-        order_id = int(parts[1])
-        cur = supabase.table("WebsiteOrders").select("*").eq("id", order_id).execute()
+        m = parse_command(message, "Usage: /D <OrderID>")
+        if not m:
+            return
+        order_id = int(m["id"])
+        cur = supabase.table("WebsiteOrders").select(ORDER_STATUS_COLUMNS).eq("id", order_id).execute()
         if not cur.data:
             return bot.reply_to(message, "Order not found.")
         order = cur.data[0]
@@ -719,7 +1099,7 @@ def admin_mark_completed(message):
 
         supabase.table("WebsiteOrders").update({
             "status": "Completed",
-            "completed_at": datetime.utcnow().isoformat()
+            "completed_at": iso_now()
         }).eq("id", order_id).execute()
 
         bot.reply_to(message, f"✅ Order {order_id} marked as Completed")
@@ -732,14 +1112,13 @@ def admin_mark_completed(message):
         bot.reply_to(message, f"⚠️ Error: {e}")
 
 
-@bot.message_handler(commands=['F'])
 def admin_mark_failed(message):
     try:
-        parts = message.text.split()
-        if len(parts) < 2:
-            return bot.reply_to(message, "Usage: /F <OrderID>")
-        order_id = int(parts[1])
-        cur = supabase.table("WebsiteOrders").select("*").eq("id", order_id).execute()
+        m = parse_command(message, "Usage: /F <OrderID>")
+        if not m:
+            return
+        order_id = int(m["id"])
+        cur = supabase.table("WebsiteOrders").select(ORDER_STATUS_COLUMNS).eq("id", order_id).execute()
         if not cur.data:
             return bot.reply_to(message, "Order not found.")
         order = cur.data[0]
@@ -756,24 +1135,88 @@ def admin_mark_failed(message):
         bot.reply_to(message, f"⚠️ Error: {e}")
 
 
+# Transaction and order admin commands share one handler that dispatches
+# on the command verb
+ADMIN_CMDS = {
+    "Yes": yes_command,
+    "No": no_command,
+    "Use": use_command,
+    "D": admin_mark_completed,
+    "F": admin_mark_failed,
+}
+_ADMIN_CMD_RE = re.compile(r"^/(%s)(?:@\w+)?(?:\s|$)" % "|".join(ADMIN_CMDS))
+
+def is_admin_command(message):
+    return bool(message.text and _ADMIN_CMD_RE.match(message.text))
+
+@bot.message_handler(func=is_admin_command)
+@pooled
+def admin_command(message):
+    ADMIN_CMDS[_ADMIN_CMD_RE.match(message.text).group(1)](message)
+
+
+# The services catalog is small and changes rarely, so it is kept in
+# memory keyed by lower-cased name and refreshed every 10 minutes.
+SERVICE_COLUMNS = "id,service_name,buy_price,sell_price,per_quantity,total_sold_qty"
+SERVICES_MISS_REFRESH = 60  # seconds between reloads triggered by an unknown name
+_SERVICES_CACHE = {}
+_services_loaded_at = 0.0
+_services_lock = threading.Lock()
+
+def refresh_services():
+    global _SERVICES_CACHE, _services_loaded_at
+    rows = db_call(supabase.table("services").select(SERVICE_COLUMNS)).data or []
+    services = {(r.get("service_name") or "").lower(): r for r in rows}
+    with _services_lock:
+        _SERVICES_CACHE = services
+        _services_loaded_at = time.monotonic()
+
+def _lookup_service(name):
+    svc = _SERVICES_CACHE.get(name)
+    if svc is None:
+        svc = next((r for n, r in _SERVICES_CACHE.items() if name in n), None)
+    return svc
 
 def find_service_for_order(order):
+    svc_name = (order.get("service") or "").lower()
+    if not svc_name:
+        return None
     try:
-        svc_name = order.get("service")
-        if svc_name:
-            r = supabase.table("services").select("*").eq("service_name", svc_name).execute()
-            if r.data:
-                return r.data[0]
-            rows = supabase.table("services").select("*").ilike("service_name", f"%{svc_name}%").limit(1).execute()
-            if rows.data:
-                return rows.data[0]
+        if not _SERVICES_CACHE:
+            refresh_services()
+        svc = _lookup_service(svc_name)
+        # A new service may have been added since the last refresh
+        if svc is None and time.monotonic() - _services_loaded_at > SERVICES_MISS_REFRESH:
+            refresh_services()
+            svc = _lookup_service(svc_name)
+        return svc
     except Exception as e:
         print("find_service_for_order error:", e)
     return None
 
+def clear_service_cache():
+    """Drop the services map; the next lookup reloads it"""
+    global _SERVICES_CACHE
+    with _services_lock:
+        _SERVICES_CACHE = {}
+
+_SUPPLIER_NOTICE_TPL = (
+    "📦 {title}\n"
+    "🧾 Order ID: {id}\n"
+    "🧩 Service: {service}\n"
+    "👤 User: {email}\n"
+    "📊 Quantity: {qty}\n"
+    "⏳ Remain: {remain}\n"
+    "✅ Done Qty: {done_qty}\n"
+    "💰 Amount: ${amount:.4f}\n"
+    "💸 Refund: ${refund:.4f}\n"
+    "📈 Spend Added: ${spend:.4f}\n"
+    "🔄 New Status: {status}\n"
+    "🕒 Time: {time}"
+)
+
 def adjust_service_qty_on_status_change(order, old_status, new_status):
     try:
-        old = (old_status or "").lower()
         new = (new_status or "").lower()
         qty = int(order.get("quantity") or 0)
         remain = int(order.get("remain") or 0) if order.get("remain") is not None else 0
@@ -785,193 +1228,195 @@ def adjust_service_qty_on_status_change(order, old_status, new_status):
         if not svc:
             print("Service not found for order", order.get("id"))
             return
-        svc_id = svc.get("id")
 
         def notify_supplier(title, refund_amount=0, spend_amount=0, done_qty=0):
-            msg = (
-                f"📦 {title}\n"
-                f"🧾 Order ID: {order.get('id')}\n"
-                f"🧩 Service: {service_name}\n"
-                f"👤 User: {email}\n"
-                f"📊 Quantity: {qty}\n"
-                f"⏳ Remain: {remain}\n"
-                f"✅ Done Qty: {done_qty}\n"
-                f"💰 Amount: ${sell_price:.4f}\n"
-                f"💸 Refund: ${refund_amount:.4f}\n"
-                f"📈 Spend Added: ${spend_amount:.4f}\n"
-                f"🔄 New Status: {new.capitalize()}\n"
-                f"🕒 Time: {datetime.now(ZoneInfo('Asia/Yangon')).strftime('%Y-%m-%d %H:%M:%S')}"
+            msg = _SUPPLIER_NOTICE_TPL.format(
+                title=title, id=order.get("id"), service=service_name, email=email,
+                qty=qty, remain=remain, done_qty=done_qty, amount=sell_price,
+                refund=refund_amount, spend=spend_amount, status=new.capitalize(),
+                time=now_yangon().strftime("%Y-%m-%d %H:%M:%S"),
             )
             safe_send(SUPPLIER_GROUP_ID, msg)
 
 
-        def handle_referral_and_bonus(amount, add=True):
-            user_data = supabase.table("users").select("ref_owner_id", "total_spend").eq("email", email).execute().data
-            if not user_data:
+        def notify_referral(ref, add):
+            if not ref:
                 return
-            user_info = user_data[0]
-            ref_owner = user_info.get("ref_owner_id")
+            ref_owner = ref.get("ref_owner_id")
             if ref_owner:
-                delta = amount * 0.04
-                if not add:
-                    delta = -delta
-                current_withdraw = supabase.table("users").select("withdrawable_balance").eq("id", ref_owner).execute().data[0].get("withdrawable_balance") or 0
-                supabase.table("users").update({"withdrawable_balance": current_withdraw + delta}).eq("id", ref_owner).execute()
-                safe_send(GROUP_ID, f"💰 Referral Owner reward {'added' if add else 'deducted'}: ${delta:.4f} for ref_owner_id {ref_owner}")
-            total_spend = float(user_info.get("total_spend") or 0)
-            if total_spend > 10:
-                bonus = amount * 0.01
-                if not add:
-                    bonus = -bonus
-                update_user_balance(email, bonus)
-                safe_send(GROUP_ID, f"🎁 User bonus {'added' if add else 'deducted'}: ${bonus:.4f} for {email}")
-
-        if new == "completed" and old != "completed":
-            cur_qty = int(svc.get("total_sold_qty") or 0)
-            supabase.table("services").update({"total_sold_qty": cur_qty + qty}).eq("id", svc_id).execute()
-            if email and sell_price:
-                user = supabase.table("users").select("total_spend").eq("email", email).execute().data
-                if user:
-                    total_spend = float(user[0].get("total_spend") or 0) + sell_price
-                    supabase.table("users").update({"total_spend": total_spend}).eq("email", email).execute()
-            handle_referral_and_bonus(sell_price, add=True)
-            notify_supplier("✅ Completed Order", refund_amount=0, spend_amount=sell_price, done_qty=qty)
-
-        elif old == "completed" and new in ("partial", "canceled", "cancelled"):
-            cur_qty = int(svc.get("total_sold_qty") or 0)
-            supabase.table("services").update({"total_sold_qty": max(0, cur_qty - qty)}).eq("id", svc_id).execute()
-            if email and qty and sell_price:
-                refund_amount = (remain / qty) * sell_price if remain else sell_price
-                user = supabase.table("users").select("total_spend").eq("email", email).execute().data
-                if user:
-                    total_spend = float(user[0].get("total_spend") or 0) - refund_amount
-                    supabase.table("users").update({"total_spend": max(0, total_spend)}).eq("email", email).execute()
-                update_user_balance(email, refund_amount)
-                supabase.table("WebsiteOrders").update({"refund_amount": refund_amount, "status": "Refunded"}).eq("id", order.get("id")).execute()
-                handle_referral_and_bonus(refund_amount, add=False)
-                notify_supplier("♻️ Completed → Refunded", refund_amount=refund_amount, done_qty=0)
-                safe_send(GROUP_ID, f"🔁 Refunded ${refund_amount:.4f} to {email} for order {order.get('id')} (remain {remain})", )
-
-        elif new in ("partial", "canceled", "cancelled") and old not in ("completed", "partial", "canceled", "cancelled"):
-            done_qty = max(0, qty - remain)
-            cur_qty = int(svc.get("total_sold_qty") or 0)
-            supabase.table("services").update({"total_sold_qty": cur_qty + done_qty}).eq("id", svc_id).execute()
-            if qty > 0 and sell_price > 0:
-                refund_amount = (sell_price / qty) * remain
-                spend_amount = sell_price - refund_amount
-                user = supabase.table("users").select("total_spend").eq("email", email).execute().data
-                if user:
-                    total_spend = float(user[0].get("total_spend") or 0) + spend_amount
-                    supabase.table("users").update({"total_spend": total_spend}).eq("email", email).execute()
-                update_user_balance(email, refund_amount)
-                supabase.table("WebsiteOrders").update({"refund_amount": refund_amount, "status": "Refunded"}).eq("id", order.get("id")).execute()
-                notify_supplier("💸 Partial/Canceled Order", refund_amount=refund_amount, spend_amount=spend_amount, done_qty=done_qty)
-                safe_send(GROUP_ID, f"💸 {email} refunded ${refund_amount:.4f} for {service_name} (remain {remain})")
+                safe_send(GROUP_ID, f"💰 Referral Owner reward {'added' if add else 'deducted'}: ${ref['ref_delta']:.4f} for ref_owner_id {ref_owner}")
+            if ref.get("bonus"):
+                safe_send(GROUP_ID, f"🎁 User bonus {'added' if add else 'deducted'}: ${ref['bonus']:.4f} for {email}")
+
+        # All balance/counter/refund writes happen in one transaction
+        result = db_call(supabase.rpc("adjust_order_status", {
+            "p_order_id": order.get("id"), "p_svc_id": svc.get("id"), "p_email": email,
+            "p_qty": qty, "p_remain": remain, "p_sell": sell_price,
+            "p_old": old_status, "p_new": new_status,
+        }), idempotent=False).data
+        if not result:
+            return
+        kind = result["kind"]
+        refund_amount = float(result.get("refund") or 0)
+        spend_amount = float(result.get("spend") or 0)
+
+        if kind == "completed":
+            notify_referral(result.get("referral"), add=True)
+            notify_supplier("✅ Completed Order", refund_amount=0, spend_amount=spend_amount, done_qty=result["done_qty"])
+
+        elif kind == "reversed" and result.get("refunded"):
+            notify_referral(result.get("referral"), add=False)
+            notify_supplier("♻️ Completed → Refunded", refund_amount=refund_amount, done_qty=0)
+            safe_send(GROUP_ID, f"🔁 Refunded ${refund_amount:.4f} to {email} for order {order.get('id')} (remain {remain})", )
+
+        elif kind == "refunded" and result.get("refunded"):
+            notify_supplier("💸 Partial/Canceled Order", refund_amount=refund_amount, spend_amount=spend_amount, done_qty=result["done_qty"])
+            safe_send(GROUP_ID, f"💸 {email} refunded ${refund_amount:.4f} for {service_name} (remain {remain})")
     except Exception as e:
         print("adjust_service_qty_on_status_change error:", e)
         traceback.print_exc()
 
-def smmgen_status_loop():
-    while True:
-        try:
-            rows = supabase.table("WebsiteOrders").select("*").eq("supplier_name","smmgen").not_.is_("supplier_order_id", None).neq("status", "Completed").execute().data or []
-            for r in rows:
-                oid = r.get("supplier_order_id")
-                if not oid:
-                    continue
-                payload = {"key": SMMGEN_API_KEY, "action": "status", "orders": str(oid)}
-                try:
-                    resp = requests.post(SMMGEN_URL, data=payload, timeout=25).json()
-                except Exception as e:
-                    print("SMMGEN status request error:", e)
+# Statuses SMMGEN can still move an order out of; anything else is final
+SMMGEN_OPEN_STATUSES = ["Pending", "Processing", "In progress"]
+
+# Columns read by the status loop and adjust_service_qty_on_status_change
+ORDER_STATUS_COLUMNS = "id,supplier_order_id,status,quantity,remain,sell_charge,email,service"
+
+def smmgen_status_updates(info):
+    """Column updates for one SMMGEN status entry"""
+    updates = {}
+    if "remains" in info:
+        try: updates["remain"] = int(float(info["remains"]))
+        except: pass
+    if "start_count" in info:
+        try: updates["start_count"] = int(float(info["start_count"]))
+        except: pass
+    if "charge" in info:
+        try: updates["buy_charge"] = float(info["charge"])
+        except: pass
+    if info.get("status"):
+        updates["status"] = info["status"]
+    return updates
+
+def apply_status_change(oid, order, new_status):
+    """React to an SMMGEN status change once it has been stored"""
+    old_status = order.get("status") or ""
+    adjust_service_qty_on_status_change(order, old_status, new_status)
+    msg = f"✅ Order #{oid} Status Changed\n🕒 Old: {old_status}\n🚀 New: {new_status}"
+    safe_send(SUPPLIER_GROUP_ID, msg)
+
+# Status chunks are fetched concurrently over the pooled smmgen_session
+STATUS_POOL = ThreadPoolExecutor(max_workers=4)
+
+def fetch_smmgen_status(chunk):
+    payload = {"key": SMMGEN_API_KEY, "action": "status", "orders": ",".join(chunk)}
+    try:
+        return orjson.loads(smmgen_session.post(SMMGEN_URL, data=payload, timeout=25).content)
+    except Exception as e:
+        print("SMMGEN status request error:", e)
+        return None
+
+def smmgen_poll_once():
+    """One SMMGEN status pass; run by the scheduler every 60s"""
+    try:
+        rows = supabase.table("WebsiteOrders").select(ORDER_STATUS_COLUMNS).eq("supplier_name","smmgen").not_.is_("supplier_order_id", None).in_("status", SMMGEN_OPEN_STATUSES).execute().data or []
+        rows_by_oid = defaultdict(list)
+        for r in rows:
+            if r.get("supplier_order_id"):
+                rows_by_oid[str(r["supplier_order_id"])].append(r)
+        oids = list(rows_by_oid)
+
+        # action=status accepts up to 100 comma-separated ids per request
+        batches = list(chunks(oids, SMMGEN_STATUS_BATCH))
+        updates, changed = [], []
+        for chunk, resp in zip(batches, STATUS_POOL.map(fetch_smmgen_status, batches)):
+            if not isinstance(resp, dict):
+                continue
+            for oid in chunk:
+                info = resp.get(oid)
+                if not isinstance(info, dict) or "error" in info:
                     continue
-                info = resp.get(str(oid)) or resp.get(oid) or resp
-                if not info:
+                cols = smmgen_status_updates(info)
+                if not cols:
                     continue
-                new_status = info.get("status")
-                updates = {}
-                if "remains" in info:
-                    try: updates["remain"] = int(float(info["remains"]))
-                    except: pass
-                if "start_count" in info:
-                    try: updates["start_count"] = int(float(info["start_count"]))
-                    except: pass
-                if "charge" in info:
-                    try: updates["buy_charge"] = float(info["charge"])
-                    except: pass
-                if new_status:
-                    updates["status"] = new_status
-                if updates:
-                    cur = supabase.table("WebsiteOrders").select("*").eq("supplier_order_id", str(oid)).execute()
-                    old_order = cur.data[0] if cur and cur.data else {}
-                    old_status = old_order.get("status", "")
-                    supabase.table("WebsiteOrders").update(updates).eq("supplier_order_id", str(oid)).execute()
-                    if new_status and old_status.lower() != new_status.lower():
-                        adjust_service_qty_on_status_change(old_order, old_status, new_status)
-                        msg = f"✅ Order #{oid} Status Changed\n🕒 Old: {old_status}\n🚀 New: {new_status}"
-                        bot.send_message(SUPPLIER_GROUP_ID, msg)
-        except Exception as e:
-            print("smmgen_status_loop error:", e)
-        time.sleep(60)
+                new_status = cols.get("status")
+                for order in rows_by_oid[oid]:
+                    updates.append({"id": order["id"], **cols})
+                    if new_status and (order.get("status") or "").lower() != new_status.lower():
+                        # Refunds use the remain SMMGEN just reported; the
+                        # status stays the stored one so old_status is right
+                        changed.append((oid, {**order, "remain": cols.get("remain", order.get("remain"))}, new_status))
+
+        # One write for the whole pass, then the status-change side effects
+        if updates:
+            db_call(supabase.rpc("bulk_update_orders", {"p_rows": updates}))
+        for oid, order, new_status in changed:
+            try:
+                apply_status_change(oid, order, new_status)
+            except Exception as e:
+                print("apply_status_change error:", e)
+    except Exception as e:
+        print("smmgen_poll_once error:", e)
 
 # ---------------------------
 # PROFIT CALCULATION
 
 
 def calculate_profit():
+    now = datetime.now()
     try:
         # Fetch services with sold quantities
-        services_res = safe_execute(lambda: supabase.table("services").select("*").gt("total_sold_qty", 0).execute())
+        services_res = db_call(supabase.table("services").select("id,service_name,sell_price,buy_price,total_sold_qty,per_quantity").gt("total_sold_qty", 0))
         services = services_res.data or []
         if not services:
             safe_send(REPORT_GROUP_ID, "📊 No sold services found today.", parse_mode="HTML")
             return
 
-        total_profit_usd = 0
-        profit_rows = []
-        service_lines = []
-
-        # Calculate per service profit
-        for idx, s in enumerate(services, start=1):
-            service_name = (s.get("service_name", "Unknown"))
-            sell_price = float(s.get("sell_price") or 0)
-            buy_price = float(s.get("buy_price") or 0)
-            qty = int(s.get("total_sold_qty") or 0)
-            per_qty = int(s.get("per_quantity") or 1000)
-
-            # ✅ Corrected profit formula (per 1000 or per_quantity base)
-            profit_usd = ((sell_price - buy_price) / per_qty) * qty
-            profit_mmk = profit_usd * USD_TO_MMK
-            total_profit_usd += profit_usd
-
-            profit_rows.append({
-                "Service Name": service_name,
-                "Quantity": qty,
-                "Buy Price ($)": buy_price,
-                "Sell Price ($)": sell_price,
-                "Profit (USD)": round(profit_usd, 2),
-                "Profit (MMK)": round(profit_mmk, 0)
-            })
-
-            service_lines.append(
-                f"{idx}. {service_name}\n"
-                f"   • Qty: {qty}\n"
-                f"   • Buy: ${buy_price:.3f} | Sell: ${sell_price:.3f} (per {per_qty})\n"
-                f"   • Profit: ${profit_usd:.2f} ({profit_mmk:,.0f} Ks)"
-            )
+        # pandas is only needed for the daily report; importing it here
+        # keeps it (and NumPy) out of the bot's start-up path
+        import pandas as pd
+
+        # Calculate per service profit, vectorized over all services
+        svc = pd.DataFrame(services)
+        svc["sell_price"] = pd.to_numeric(svc["sell_price"], errors="coerce").fillna(0)
+        svc["buy_price"] = pd.to_numeric(svc["buy_price"], errors="coerce").fillna(0)
+        svc["total_sold_qty"] = pd.to_numeric(svc["total_sold_qty"], errors="coerce").fillna(0).astype(int)
+        svc["per_quantity"] = pd.to_numeric(svc["per_quantity"], errors="coerce").fillna(0).astype(int).replace(0, 1000)
+
+        # ✅ Corrected profit formula (per 1000 or per_quantity base)
+        svc["profit_usd"] = (svc["sell_price"] - svc["buy_price"]) / svc["per_quantity"] * svc["total_sold_qty"]
+        svc["profit_mmk"] = svc["profit_usd"] * USD_TO_MMK
+        total_profit_usd = float(svc["profit_usd"].sum())
+
+        df = pd.DataFrame({
+            "Service Name": svc["service_name"],
+            "Quantity": svc["total_sold_qty"],
+            "Buy Price ($)": svc["buy_price"],
+            "Sell Price ($)": svc["sell_price"],
+            "Profit (USD)": svc["profit_usd"].round(2),
+            "Profit (MMK)": svc["profit_mmk"].round(0),
+        })
+
+        service_lines = [
+            f"{idx}. {row.service_name}\n"
+            f"   • Qty: {row.total_sold_qty}\n"
+            f"   • Buy: ${row.buy_price:.3f} | Sell: ${row.sell_price:.3f} (per {row.per_quantity})\n"
+            f"   • Profit: ${row.profit_usd:.2f} ({row.profit_mmk:,.0f} Ks)"
+            for idx, row in enumerate(svc.itertuples(index=False), start=1)
+        ]
 
         # Totals
         total_profit_mmk = total_profit_usd * USD_TO_MMK
-        users_res = safe_execute(lambda: supabase.table("users").select("balance_usd").execute())
+        users_res = db_call(supabase.table("users").select("balance_usd"))
         users = users_res.data or []
         total_balance_usd = sum(float(u.get("balance_usd") or 0) for u in users)
         total_balance_mmk = total_balance_usd * USD_TO_MMK
 
         # Save Excel report
-        df = pd.DataFrame(profit_rows)
         df.loc[len(df.index)] = ["TOTAL", "", "", "", round(total_profit_usd, 2), round(total_profit_mmk, 0)]
-        report_filename = f"./DailyProfitReport_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx"
-        df.to_excel(report_filename, index=False)
+        report_file = io.BytesIO()
+        df.to_excel(report_file, index=False, engine="xlsxwriter")
+        report_file.name = f"DailyProfitReport_{now.strftime('%Y%m%d_%H%M%S')}.xlsx"
 
         # Summary text
         service_report = "\n\n".join(service_lines)
@@ -987,25 +1432,30 @@ def calculate_profit():
             "📦 *Service-wise Profits*\n\n"
             f"{service_report}\n"
             "━━━━━━━━━━━━━━━\n"
-            f"🕒 Report Time: {datetime.now().strftime('%I:%M %p, %d-%b-%Y')}\n"
+            f"🕒 Report Time: {now.strftime('%I:%M %p, %d-%b-%Y')}\n"
             "✅ Total sold quantities reset to 0."
         )
 
-        # Telegram message size guard (split long messages)
-        parts = [summary_text[i:i + 3500] for i in range(0, len(summary_text), 3500)]
-        for part in parts:
-            safe_send(REPORT_GROUP_ID, part)
+        # Inline so the summary arrives before the spreadsheet
+        send_now(REPORT_GROUP_ID, summary_text)
 
         # Send Excel file
         try:
-            with open(report_filename, "rb") as doc:
-                bot.send_document(REPORT_GROUP_ID, doc)
+            report_file.seek(0)
+            bot.send_document(REPORT_GROUP_ID, report_file)
         except Exception as e:
             print("Failed to send report file:", e)
 
         # Reset totals
-        for s in services:
-            safe_execute(lambda sid=s["id"]: supabase.table("services").update({"total_sold_qty": 0}).eq("id", sid).execute())
+        service_ids = [s["id"] for s in services]
+        try:
+            db_call(supabase.table("services").update({"total_sold_qty": 0}).in_("id", service_ids))
+        except Exception as e:
+            print("Bulk total_sold_qty reset failed, resetting per service:", e)
+            for sid in service_ids:
+                db_call(supabase.table("services").update({"total_sold_qty": 0}).eq("id", sid))
+        finally:
+            clear_service_cache()
 
     except Exception as e:
         print("calculate_profit error:", e)
@@ -1013,11 +1463,30 @@ def calculate_profit():
         safe_send(REPORT_GROUP_ID, f"⚠️ Profit calculation failed:\n{(str(e))}")
 
 
+# Manual runs go through the single-thread "reports" executor, so they
+# never overlap the scheduled report; held while one is queued or running
+_manual_report_lock = threading.Lock()
+
+def _run_manual_report():
+    try:
+        calculate_profit()
+    finally:
+        _manual_report_lock.release()
+
 # Manual trigger command
 @bot.message_handler(commands=["calculate", "Calculate"])
 def manual_calculate(message):
-    if message.chat.id == REPORT_GROUP_ID or is_admin_chat(message.chat.id):
-        threading.Thread(target=calculate_profit, daemon=True).start()
+    if message.chat.id in ALLOWED_REPORT_CHATS:
+        if not _manual_report_lock.acquire(blocking=False):
+            bot.reply_to(message, "⏳ A report is already running.")
+            return
+        try:
+            # No misfire grace: a run queued behind the daily report must
+            # still start, or the lock would never be released
+            scheduler.add_job(_run_manual_report, executor="reports", misfire_grace_time=None)
+        except Exception:
+            _manual_report_lock.release()
+            raise
     else:
         bot.reply_to(message, "❌ This command is only for the report group or admins.")
 
@@ -1026,63 +1495,100 @@ def manual_calculate(message):
 # ---------------------------
 def check_smmgen_service_rates():
     try:
-        res = supabase.table("services").select("*").eq("source", "smmgen").execute()
+        res = supabase.table("services").select("id,service_id,service_name,buy_price").eq("source", "smmgen").execute()
         services_rows = res.data or []
         payload = {"key": SMMGEN_API_KEY, "action": "services"}
         r = safe_request("POST", SMMGEN_URL, data=payload, timeout=15)
-        smmgen_services = r.json()
+        smmgen_services = orjson.loads(r.content)
+        api_by_id = {str(s.get("service")): s for s in smmgen_services}
+        price_updates = []
         for row in services_rows:
             service_id = row.get("service_id")
             row_buy_price = float(row.get("buy_price", 0))
-            api_service = next((s for s in smmgen_services if str(s.get("service")) == str(service_id)), None)
+            api_service = api_by_id.get(str(service_id))
             if api_service:
                 api_rate = float(api_service.get("rate", 0))
                 if row_buy_price != api_rate:
                     msg = (
                         "⚠️ <b>SMMGEN Rate Mismatch</b>\n\n"
                         f"🆔 Service Row ID: {row.get('id')}\n"
-                        f"📦 Service Name: {row.get('service')}\n"
+                        f"📦 Service Name: {row.get('service_name')}\n"
                         f"💰 Local Buy Price: {row_buy_price}\n"
                         f"💵 SMMGEN API Rate: {api_rate}\n\n"
                         "✅ Updating local buy_price to API rate..."
                     )
                     safe_send(GROUP_ID, msg)
-                    safe_execute(lambda: supabase.table("services").update({"buy_price": api_rate}).eq("id", row.get("id")).execute())
+                    price_updates.append({"id": row.get("id"), "buy_price": api_rate})
+        # One write for every changed price, then reload the services map
+        # once so lookups see them
+        if price_updates:
+            db_call(supabase.rpc("bulk_update_buy_prices", {"p_rows": price_updates}))
+            refresh_services()
     except Exception as e:
         print("check_smmgen_service_rates error:", e)
         traceback.print_exc()
 
 
-
-if __name__ == "__main__":
-    threading.Thread(target=poll_transactions, daemon=True).start()
-    threading.Thread(target=poll_affiliate, daemon=True).start()
-    threading.Thread(target=poll_supportbox, daemon=True).start()
-    threading.Thread(target=check_new_orders_loop, daemon=True).start()
-    threading.Thread(target=smmgen_status_loop, daemon=True).start()
-     
-
-    # Run Flask server on background
-    threading.Thread(target=lambda: app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 10000))), daemon=True).start()
-
-    # Start Telegram bot
-    bot.polling(none_stop=True)
+# ---------------------------
+# TELEGRAM WEBHOOK
+# ---------------------------
+@app.route(f"/tg/{BOT_TOKEN}", methods=["POST"])
+def telegram_webhook():
+    update = telebot.types.Update.de_json(request.get_data(as_text=True))
+    bot.process_new_updates([update])
+    return "ok"
 
 
 # ---------------------------
-# FLASK ROUTES (web service triggers)
+# BACKGROUND LOOPS
 # ---------------------------
+_LOOP_THREADS = {}
+_loop_threads_lock = threading.Lock()
+
+def ensure_loop(name, fn):
+    """Start fn on a daemon thread unless a live thread already runs it"""
+    with _loop_threads_lock:
+        t = _LOOP_THREADS.get(name)
+        if t and t.is_alive():
+            return False
+        t = threading.Thread(target=fn, daemon=True, name=name)
+        t.start()
+        _LOOP_THREADS[name] = t
+        return True
+
 
 if __name__ == "__main__":
+    for i in range(TG_WORKERS):
+        ensure_loop(f"tg_worker_{i}", functools.partial(_tg_worker, i))
+    ensure_loop("poll_transactions", poll_transactions)
+    ensure_loop("poll_affiliate", poll_affiliate)
+    ensure_loop("poll_supportbox", poll_supportbox)
+    ensure_loop("check_new_orders", check_new_orders_loop)
+
+    scheduler.add_job(calculate_profit, 'cron', hour=8, minute=0, executor='reports')            # 08:00 UTC == 14:30 Yangon (approx)
+    scheduler.add_job(check_smmgen_service_rates, 'cron', hour=8, minute=30)   # run rates check daily ~14:30 Yangon
+    scheduler.add_job(refresh_services, 'interval', minutes=10)
+    scheduler.add_job(smmgen_poll_once, 'interval', seconds=60)
+    scheduler.start()
+
+    port = int(os.environ.get("PORT", 10000))
+    if PUBLIC_URL:
+        # Telegram pushes updates to /tg/<token>; Flask serves them
+        bot.remove_webhook()
+        bot.set_webhook(
+            url=f"{PUBLIC_URL}/tg/{BOT_TOKEN}",
+            drop_pending_updates=True, allowed_updates=['message'],
+        )
+    else:
+        # getUpdates answers 409 while a webhook from an earlier deploy is set
+        bot.remove_webhook()
+        ensure_loop("telegram_polling", functools.partial(
+            bot.infinity_polling, timeout=20, long_polling_timeout=20,
+            skip_pending=True, allowed_updates=['message'],
+        ))
+
+    # Flask owns the main thread; everything else runs in the background
     try:
-        scheduler.add_job(calculate_profit, 'cron', hour=8, minute=0)              # 08:00 UTC == 14:30 Yangon (approx)
-        scheduler.add_job(check_smmgen_service_rates, 'cron', hour=8, minute=30)   # run rates check daily ~14:30 Yangon
-        scheduler.start()
-        app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
+        app.run(host="0.0.0.0", port=port)
     except (KeyboardInterrupt, SystemExit):
         pass
-
-
-
-
-
@@ -0,0 +1,12 @@
+-- Atomically add p_amount to a user's balance and return the new balance.
+-- Returns NULL when the user does not exist or p_amount is 0.
+create or replace function add_balance(p_email text, p_amount numeric)
+returns numeric
+language sql
+as $$
+  update users
+     set balance_usd = coalesce(balance_usd, 0) + p_amount
+   where email = p_email
+     and p_amount <> 0
+  returning balance_usd;
+$$;
@@ -0,0 +1,86 @@
+-- Apply the side effects of an order status change in one transaction:
+-- services.total_sold_qty, users.total_spend, the user's refund, the
+-- order's refund_amount/status and the referral/bonus adjustment.
+-- Order values are passed in as the caller saw them before the change.
+-- Requires add_balance, increment_sold_qty, add_total_spend and
+-- apply_referral_bonus.
+--
+-- Returns NULL when the transition has no side effects, otherwise
+-- {kind, refunded, done_qty, refund, spend, referral} where kind is
+-- 'completed', 'reversed' (completed -> partial/canceled) or 'refunded'
+-- (open -> partial/canceled), and referral is apply_referral_bonus's
+-- result.
+create or replace function adjust_order_status(
+  p_order_id bigint,
+  p_svc_id bigint,
+  p_email text,
+  p_qty integer,
+  p_remain integer,
+  p_sell numeric,
+  p_old text,
+  p_new text
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+  v_old text := lower(coalesce(p_old, ''));
+  v_new text := lower(coalesce(p_new, ''));
+  v_qty integer := coalesce(p_qty, 0);
+  v_remain integer := coalesce(p_remain, 0);
+  v_sell numeric := coalesce(p_sell, 0);
+  v_kind text;
+  v_refunded boolean := false;
+  v_done integer := 0;
+  v_refund numeric := 0;
+  v_spend numeric := 0;
+  v_referral jsonb;
+begin
+  if v_new = 'completed' and v_old <> 'completed' then
+    v_kind := 'completed';
+    v_done := v_qty;
+    v_spend := v_sell;
+    perform increment_sold_qty(p_svc_id, v_qty);
+    perform add_total_spend(p_email, v_sell);
+    v_referral := apply_referral_bonus(p_email, v_sell, true);
+
+  elsif v_old = 'completed' and v_new in ('partial', 'canceled', 'cancelled') then
+    v_kind := 'reversed';
+    perform increment_sold_qty(p_svc_id, -v_qty);
+    if p_email is not null and v_qty <> 0 and v_sell <> 0 then
+      v_refunded := true;
+      v_refund := case when v_remain <> 0 then v_remain::numeric / v_qty * v_sell else v_sell end;
+      perform add_total_spend(p_email, -v_refund);
+      perform add_balance(p_email, v_refund);
+      update "WebsiteOrders" set refund_amount = v_refund, status = 'Refunded' where id = p_order_id;
+      v_referral := apply_referral_bonus(p_email, v_refund, false);
+    end if;
+
+  elsif v_new in ('partial', 'canceled', 'cancelled')
+        and v_old not in ('completed', 'partial', 'canceled', 'cancelled') then
+    v_kind := 'refunded';
+    v_done := greatest(0, v_qty - v_remain);
+    perform increment_sold_qty(p_svc_id, v_done);
+    if v_qty > 0 and v_sell > 0 then
+      v_refunded := true;
+      v_refund := v_sell / v_qty * v_remain;
+      v_spend := v_sell - v_refund;
+      perform add_total_spend(p_email, v_spend);
+      perform add_balance(p_email, v_refund);
+      update "WebsiteOrders" set refund_amount = v_refund, status = 'Refunded' where id = p_order_id;
+    end if;
+
+  else
+    return null;
+  end if;
+
+  return jsonb_build_object(
+    'kind', v_kind,
+    'refunded', v_refunded,
+    'done_qty', v_done,
+    'refund', v_refund,
+    'spend', v_spend,
+    'referral', v_referral
+  );
+end;
+$$;
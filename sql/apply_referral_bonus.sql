@@ -0,0 +1,44 @@
+-- Apply the referral reward (4% to the referrer's withdrawable balance)
+-- and the loyalty bonus (1% back to users with total_spend > 10) for an
+-- order amount, in one transaction. p_add = false reverses both.
+-- Returns the applied deltas for logging, or NULL if the user is unknown.
+create or replace function apply_referral_bonus(p_email text, p_amount numeric, p_add boolean)
+returns jsonb
+language plpgsql
+as $$
+declare
+  v_ref_owner users.ref_owner_id%type;
+  v_total_spend numeric;
+  v_sign numeric := case when p_add then 1 else -1 end;
+  v_ref_delta numeric := 0;
+  v_bonus numeric := 0;
+begin
+  select ref_owner_id, coalesce(total_spend, 0)
+    into v_ref_owner, v_total_spend
+    from users
+   where email = p_email;
+  if not found then
+    return null;
+  end if;
+
+  if v_ref_owner is not null then
+    v_ref_delta := v_sign * p_amount * 0.04;
+    update users
+       set withdrawable_balance = coalesce(withdrawable_balance, 0) + v_ref_delta
+     where id = v_ref_owner;
+  end if;
+
+  if v_total_spend > 10 then
+    v_bonus := v_sign * p_amount * 0.01;
+    update users
+       set balance_usd = coalesce(balance_usd, 0) + v_bonus
+     where email = p_email;
+  end if;
+
+  return jsonb_build_object(
+    'ref_owner_id', v_ref_owner,
+    'ref_delta', v_ref_delta,
+    'bonus', v_bonus
+  );
+end;
+$$;
@@ -0,0 +1,11 @@
+-- Set services.buy_price for many rows in one call.
+-- p_rows is a JSON array of {"id": ..., "buy_price": ...} objects.
+create or replace function bulk_update_buy_prices(p_rows jsonb)
+returns void
+language sql
+as $$
+  update services s
+     set buy_price = r.buy_price
+    from jsonb_to_recordset(p_rows) as r(id bigint, buy_price numeric)
+   where s.id = r.id;
+$$;
@@ -0,0 +1,20 @@
+-- Number of action=add attempts made for an SMMGEN order.
+alter table "WebsiteOrders" add column if not exists smmgen_attempts integer;
+
+-- Apply the SMMGEN status poll's per-row updates to many WebsiteOrders in
+-- one call. p_rows is a JSON array of objects keyed by WebsiteOrders
+-- columns; each must carry "id". Columns that are absent (or null) keep
+-- their value. supplier_order_id is written per order as soon as SMMGEN
+-- accepts it, never batched, so it is not updated here.
+create or replace function bulk_update_orders(p_rows jsonb)
+returns void
+language sql
+as $$
+  update "WebsiteOrders" o
+     set status = coalesce(r.status, o.status),
+         remain = coalesce(r.remain, o.remain),
+         start_count = coalesce(r.start_count, o.start_count),
+         buy_charge = coalesce(r.buy_charge, o.buy_charge)
+    from jsonb_populate_recordset(null::"WebsiteOrders", p_rows) as r
+   where o.id = r.id;
+$$;
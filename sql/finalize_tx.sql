@@ -0,0 +1,57 @@
+-- Idempotency keys: a transaction_id is credited at most once, even if
+-- the user submits it twice or two workers race on it.
+create table if not exists processed_tx (
+  transaction_id text primary key,
+  processed_at timestamptz not null default now()
+);
+
+-- Mark a VerifyPayment row used, accept its transaction and credit the
+-- user's balance in one call. Returns false (and changes nothing) if the
+-- transaction_id was already processed, the VerifyPayment row was
+-- already used, or the user could not be credited.
+create or replace function finalize_tx(p_vp_id bigint, p_tx_id bigint)
+returns boolean
+language plpgsql
+as $$
+declare
+  v_txid text;
+  v_email text;
+  v_amount numeric;
+begin
+  select transaction_id, email, amount::numeric
+    into v_txid, v_email, v_amount
+    from transactions where id = p_tx_id;
+  if v_txid is null then
+    return false;
+  end if;
+
+  insert into processed_tx (transaction_id) values (v_txid)
+  on conflict do nothing;
+  if not found then
+    return false;
+  end if;
+
+  -- Everything below rolls back together if the credit fails, so the
+  -- idempotency key is never left behind without the money.
+  begin
+    update "VerifyPayment"
+       set status = 'used'
+     where id = p_vp_id
+       and status = 'unused';
+    if not found then
+      raise exception 'payment already used' using errcode = 'P0001';
+    end if;
+
+    update transactions set status = 'Accepted' where id = p_tx_id;
+
+    if coalesce(v_amount, 0) <> 0 and add_balance(v_email, v_amount) is null then
+      raise exception 'user % not found', v_email using errcode = 'P0001';
+    end if;
+  exception when raise_exception then
+    delete from processed_tx where transaction_id = v_txid;
+    return false;
+  end;
+
+  return true;
+end;
+$$;
@@ -0,0 +1,23 @@
+-- Atomic counter updates used when an order changes status, so
+-- concurrent status events (status loop + manual /D) cannot race on a
+-- read-modify-write. Both clamp at 0 and return the new value, or NULL
+-- when the row does not exist.
+create or replace function increment_sold_qty(p_svc_id bigint, p_delta integer)
+returns integer
+language sql
+as $$
+  update services
+     set total_sold_qty = greatest(0, coalesce(total_sold_qty, 0) + p_delta)
+   where id = p_svc_id
+  returning total_sold_qty;
+$$;
+
+create or replace function add_total_spend(p_email text, p_delta numeric)
+returns numeric
+language sql
+as $$
+  update users
+     set total_spend = greatest(0, coalesce(total_spend, 0) + p_delta)
+   where email = p_email
+  returning total_spend;
+$$;
@@ -0,0 +1,27 @@
+-- Indexes for the bot's polling and lookup queries.
+-- CREATE INDEX CONCURRENTLY cannot run inside a transaction block;
+-- run this file statement by statement (e.g. psql without -1).
+
+-- poll_transactions: status = 'Pending'
+create index concurrently if not exists idx_tx_pending
+  on transactions (id)
+  where status = 'Pending';
+
+-- add_balance / update_user_balance: email = ?
+create unique index concurrently if not exists idx_users_email
+  on users (email);
+
+-- handle_transaction: transaction_id = ? and method = ? and status = 'unused'
+create index concurrently if not exists idx_verify_unused
+  on "VerifyPayment" (transaction_id, method, amount_usd)
+  where status = 'unused';
+
+-- check_new_orders_loop: status = 'Pending' and id > ? order by id
+create index concurrently if not exists idx_orders_pending
+  on "WebsiteOrders" (id)
+  where status = 'Pending';
+
+-- smmgen_poll_once: open SMMGEN orders that have a supplier_order_id
+create index concurrently if not exists idx_orders_smmgen_open
+  on "WebsiteOrders" (supplier_order_id)
+  where supplier_name = 'smmgen' and status <> 'Completed';
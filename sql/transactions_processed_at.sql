@@ -0,0 +1,5 @@
+-- Claim marker for poll_transactions: a transaction is claimed by the
+-- single UPDATE that sets processed_at while it is still NULL, so it is
+-- picked up at most once across restarts and bot instances, even if its
+-- status is later set back to Pending by hand.
+alter table transactions add column if not exists processed_at timestamptz;